@@ -1,24 +1,33 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
-import requests
-from langchain_openai import OpenAI
-from langchain.agents import AgentExecutor, create_react_agent
-from langchain.tools import Tool
-from langchain.prompts import PromptTemplate
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from fhir.resources.claim import Claim
-from fhir.resources.patient import Patient
-from fhir.resources.encounter import Encounter
-from fhir.resources.procedure import Procedure
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Dict, Any, List, Union
+from contextlib import asynccontextmanager
+import asyncio
+import httpx
+from cachetools import LRUCache, TTLCache
+import orjson
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+import hashlib
 import os
+import re
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Close the shared FHIR and OpenAI client connections on shutdown"""
+    yield
+    await _http.aclose()
+    await _openai_http.aclose()
+
 # Initialize FastAPI app
 app = FastAPI(
+    lifespan=lifespan,
     title="FHIR Resource Router",
     description="An intelligent FHIR resource routing system using LangChain",
     version="1.0.0"
@@ -27,229 +36,285 @@ app = FastAPI(
 # HAPI FHIR server base URL
 HAPI_FHIR_BASE_URL = "https://hapi.fhir.org/baseR4"
 
-# Initialize OpenAI
-llm = OpenAI(temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
+# Shared async client so connections to the FHIR server are kept alive between requests
+_http = httpx.AsyncClient(
+    base_url=HAPI_FHIR_BASE_URL,
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    transport=httpx.AsyncHTTPTransport(retries=2, limits=httpx.Limits(max_keepalive_connections=32))
+)
+
+# Shared HTTP/2 client so both models reuse warm connections to the OpenAI API
+_openai_http = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=16))
+
+# Stronger model, only used when the fast classifier does not return a label
+llm = ChatOpenAI(
+    model="gpt-4o",
+    temperature=0,
+    max_tokens=4,
+    request_timeout=15,
+    max_retries=1,
+    http_async_client=_openai_http,
+    openai_api_key=os.getenv("OPENAI_API_KEY")
+)
+
+# Small, fast model for classification; the answer is a single word
+llm_fast = ChatOpenAI(
+    model="gpt-4o-mini",
+    temperature=0,
+    max_tokens=4,
+    request_timeout=15,
+    max_retries=1,
+    http_async_client=_openai_http,
+    openai_api_key=os.getenv("OPENAI_API_KEY")
+)
 
 class ClaimBundle(BaseModel):
     resource_type: str
     requested_resource: str
     claim_data: Dict[str, Any]
+    # Explicit resource types to fetch together; skips classification when set
+    resource_types: Optional[List[str]] = None
 
 class ResourceResponse(BaseModel):
     resource_type: str
-    data: Dict[str, Any]
+    data: Dict[str, Any] = Field(default_factory=dict)
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
 
 def extract_reference_id(reference: str) -> str:
     """Extract the ID from a FHIR reference string."""
     return reference.split('/')[-1] if '/' in reference else reference
 
-def fetch_fhir_resource(resource_type: str, resource_id: str) -> Dict[str, Any]:
+def _field(element: Any, key: str) -> Any:
+    """Read a key from a claim element, or None if the element isn't an object."""
+    return element.get(key) if isinstance(element, dict) else None
+
+def _first(element: Any) -> Any:
+    """Return the first entry of a claim list, or None if it isn't a non-empty list."""
+    return element[0] if isinstance(element, list) and element else None
+
+# FHIR resource id grammar; anything else could turn the fetch into a search or inject a query
+_FHIR_ID = re.compile(r"[A-Za-z0-9\-.]{1,64}")
+
+def _normalize_ref(ref: Any) -> str:
+    """Reduce a loosely formatted reference (e.g. a dict) to a reference string, or "Not found"."""
+    if isinstance(ref, dict):
+        ref = ref.get('reference') or ref.get('id')
+    # Empty, contained ("#id") or otherwise malformed ids count as missing
+    if not isinstance(ref, str) or not _FHIR_ID.fullmatch(extract_reference_id(ref)):
+        return "Not found"
+    return ref
+
+# Recently fetched resources and their ETags, keyed on (resource_type, resource_id)
+RESOURCE_CACHE_TTL = 300
+_resource_cache: LRUCache = LRUCache(maxsize=1024)
+
+# Final claim-bundle responses, keyed on a hash of the request body
+_response_cache: TTLCache = TTLCache(maxsize=512, ttl=60)
+
+async def fetch_fhir_resource(resource_type: str, resource_id: str) -> Dict[str, Any]:
     """Fetch a FHIR resource from the HAPI FHIR server."""
-    url = f"{HAPI_FHIR_BASE_URL}/{resource_type}/{resource_id}"
-    response = requests.get(url)
+    key = (resource_type, resource_id)
+    cached = _resource_cache.get(key)
+    # Resources rarely change within a few minutes, so serve repeats from memory
+    if cached and cached["expires"] > time.monotonic():
+        return cached["body"]
+
+    # Once stale, revalidate with the stored ETag so an unchanged resource costs only a 304
+    headers = {"If-None-Match": cached["etag"]} if cached and cached["etag"] else {}
+    response = await _http.get(f"/{resource_type}/{resource_id}", headers=headers)
+    if response.status_code == 304 and cached:
+        cached["expires"] = time.monotonic() + RESOURCE_CACHE_TTL
+        return cached["body"]
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, detail=f"Error fetching {resource_type}")
-    return response.json()
 
-def get_patient_info(patient_ref: str) -> Dict[str, Any]:
+    body = response.json()
+    _resource_cache[key] = {
+        "etag": response.headers.get("ETag"),
+        "body": body,
+        "expires": time.monotonic() + RESOURCE_CACHE_TTL
+    }
+    return body
+
+async def get_patient_info(patient_ref: str) -> Dict[str, Any]:
     """Get patient information from the reference."""
     patient_id = extract_reference_id(patient_ref)
-    return fetch_fhir_resource("Patient", patient_id)
+    return await fetch_fhir_resource("Patient", patient_id)
 
-def get_encounter_info(encounter_ref: str) -> Dict[str, Any]:
+async def get_encounter_info(encounter_ref: str) -> Dict[str, Any]:
     """Get encounter information from the reference."""
-    try:
-        # Extract just the ID from the reference
-        if isinstance(encounter_ref, dict):
-            encounter_ref = encounter_ref.get('id', '')
-        elif isinstance(encounter_ref, str):
-            # If the input contains a JSON-like string, extract just the ID
-            if '{' in encounter_ref:
-                encounter_ref = encounter_ref.split('{')[0].strip()
-            # Remove any additional text after the ID
-            encounter_ref = encounter_ref.split()[0].strip()
-            # Ensure we only have the reference ID
-            if '/' in encounter_ref:
-                encounter_ref = encounter_ref.split('/')[-1]
-        encounter_id = extract_reference_id(encounter_ref)
-        return fetch_fhir_resource("Encounter", encounter_id)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing encounter reference: {str(e)}")
+    encounter_id = extract_reference_id(encounter_ref)
+    return await fetch_fhir_resource("Encounter", encounter_id)
 
-def get_procedure_info(procedure_ref: str) -> Dict[str, Any]:
+async def get_procedure_info(procedure_ref: str) -> Dict[str, Any]:
     """Get procedure information from the reference."""
     procedure_id = extract_reference_id(procedure_ref)
-    return fetch_fhir_resource("Procedure", procedure_id)
-
-# Define LangChain tools with more detailed descriptions
-tools = [
-    Tool(
-        name="get_patient",
-        func=get_patient_info,
-        description="""Use this tool when you need to get patient information. This includes:
-        - Patient demographics
-        - Personal information
-        - Medical record details
-        - Patient history
-        - Patient profile
-        Input should be the patient reference from the claim bundle."""
-    ),
-    Tool(
-        name="get_encounter",
-        func=get_encounter_info,
-        description="""Use this tool when you need to get encounter information. This includes:
-        - Visit details
-        - Hospital stay information
-        - Medical visit records
-        - Treatment episodes
-        - Care encounters
-        - Hospital information
-        Input should be just the encounter reference ID (e.g., 'Encounter/12345'). Do not include any additional data."""
-    ),
-    Tool(
-        name="get_procedure",
-        func=get_procedure_info,
-        description="""Use this tool when you need to get procedure information. This includes:
-        - Medical procedures
-        - Surgical operations
-        - Treatment procedures
-        - Medical interventions
-        - Clinical procedures
-        Input should be the procedure reference from the claim bundle."""
-    )
+    return await fetch_fhir_resource("Procedure", procedure_id)
+
+# Keywords that identify each resource type
+PATIENT_TERMS = frozenset({"patient", "demographic", "personal information", "medical record", "patient history", "patient profile"})
+ENCOUNTER_TERMS = frozenset({"encounter", "visit", "hospital stay", "medical visit", "treatment episode", "care encounter", "hospital"})
+PROCEDURE_TERMS = frozenset({"procedure", "surgical", "operation", "treatment procedure", "medical intervention", "clinical procedure"})
+
+def _compile_terms(terms: frozenset) -> "re.Pattern[str]":
+    """Compile a set of keywords into a single substring-matching pattern."""
+    return re.compile("|".join(re.escape(term) for term in sorted(terms)))
+
+_RESOURCE_PATTERNS = [
+    ("patient", _compile_terms(PATIENT_TERMS)),
+    ("encounter", _compile_terms(ENCOUNTER_TERMS)),
+    ("procedure", _compile_terms(PROCEDURE_TERMS)),
 ]
 
-# Create a custom prompt template for the ReAct agent
-prompt = ChatPromptTemplate.from_messages([
-    ("system", """You are an intelligent FHIR resource routing system. Your task is to understand the user's request and determine which FHIR resource to fetch.
-
-Available tools:
-{tools}
-
-Use the following format:
-
-Question: the input question you must answer
-Thought: you should always think about what to do
-Action: the action to take, should be one of [{tool_names}]
-Action Input: the input to the action (ONLY the reference ID, e.g., '598285')
-Observation: the result of the action
-... (this Thought/Action/Action Input/Observation can repeat N times)
-Thought: I now know the final answer
-Final Answer: the final answer to the original input question
-
-Remember:
-1. For Action, use ONLY the tool name from the list [{tool_names}]
-2. For Action Input, use ONLY the reference ID without any additional text
-3. Do not include any explanations in the Action or Action Input fields
-4. You must always choose one of the available tools
-5. Never use None as an action or input
-6. Never include the full resource data in the Action Input
-7. For encounter references, use ONLY the ID part (e.g., '598285' instead of the full reference)
-
-{agent_scratchpad}"""),
-    MessagesPlaceholder(variable_name="chat_history"),
-    ("human", "{input}")
+def _classify_from_text(text: str) -> Optional[str]:
+    """Determine the requested resource type from keywords in the text, if unambiguous."""
+    text = text.lower()
+    matches = [resource_type for resource_type, pattern in _RESOURCE_PATTERNS if pattern.search(text)]
+    # Text mentioning several resource types (e.g. "the patient's procedure") is left to the LLM
+    return matches[0] if len(matches) == 1 else None
+
+# Map each resource type to the function that fetches it
+RESOURCE_FETCHERS = {
+    "patient": get_patient_info,
+    "encounter": get_encounter_info,
+    "procedure": get_procedure_info,
+}
+
+# Prompts for classifying the request into a single resource type.
+# The system messages are static so providers can reuse them as a cached prefix;
+# only the human message varies per request.
+classify_prompt = ChatPromptTemplate.from_messages([
+    ("system", "Return exactly one word: patient, encounter, or procedure."),
+    ("human", "Request: {q}")
 ])
 
-# Create the agent using the custom prompt
-agent = create_react_agent(llm, tools, prompt)
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=True,
-    handle_parsing_errors=True,
-    return_intermediate_steps=True,
-    max_iterations=2  # Limit to 2 iterations to prevent infinite loops
-)
+# Fuller instructions, only sent when the short prompt did not yield a label
+classify_prompt_full = ChatPromptTemplate.from_messages([
+    ("system", """You are an intelligent FHIR resource routing system. Decide which FHIR resource the request is asking for.
+
+- patient: demographics, personal information, medical record details, patient history or profile
+- encounter: visit details, hospital stays, medical visit records, treatment episodes, care encounters
+- procedure: medical procedures, surgical operations, treatment procedures, medical or clinical interventions
+
+Return exactly one word: patient, encounter, or procedure."""),
+    ("human", "Request: {q}")
+])
+
+classify_chain_fast = classify_prompt | llm_fast | StrOutputParser()
+classify_chain = classify_prompt_full | llm | StrOutputParser()
+
+# Trivial variants of the labels that should not trigger an escalation
+_LABEL_ALIASES = {
+    "patients": "patient",
+    "encounters": "encounter",
+    "procedures": "procedure",
+}
+
+def _to_label(text: str) -> str:
+    """Normalize raw model output into a candidate resource type label."""
+    label = text.strip().strip(".,:;'\"").lower()
+    return _LABEL_ALIASES.get(label, label)
+
+async def _stream_label(chain, requested_resource: str) -> str:
+    """Stream the model's answer, stopping as soon as it reads as a known label."""
+    text = ""
+    stream = chain.astream({"q": requested_resource})
+    try:
+        async for chunk in stream:
+            text += chunk
+            if _to_label(text) in RESOURCE_FETCHERS:
+                break
+    finally:
+        # Release the connection without waiting for the rest of the completion
+        await stream.aclose()
+    return _to_label(text)
+
+async def classify_intent_llm(requested_resource: str) -> Optional[str]:
+    """Ask the LLM which resource type the request refers to."""
+    label = await _stream_label(classify_chain_fast, requested_resource)
+    if label in RESOURCE_FETCHERS:
+        return label
+    # Escalate to the larger model only when the fast one goes off-vocabulary
+    label = await _stream_label(classify_chain, requested_resource)
+    if label in RESOURCE_FETCHERS:
+        return label
+    # Fall back to keyword matching on whatever the LLM returned
+    return _classify_from_text(label)
+
+async def _fetch_resource(resource_type: str, references: Dict[str, str]) -> ResourceResponse:
+    """Fetch the resource of the given type using the matching reference from the claim."""
+    reference = references[resource_type]
+    if reference == "Not found":
+        raise HTTPException(status_code=400, detail=f"{resource_type.capitalize()} reference not found in claim")
+    return ResourceResponse(
+        resource_type=resource_type,
+        data=await RESOURCE_FETCHERS[resource_type](reference)
+    )
 
-@app.post("/claim-bundle", response_model=ResourceResponse)
+async def _route_claim_bundle(bundle: ClaimBundle) -> Union[ResourceResponse, Dict[str, Dict[str, Any]]]:
+    """Resolve the requested resource(s) for a claim bundle."""
+    # Extract references from the claim bundle; missing or mis-shaped elements yield None
+    claim = bundle.claim_data
+    raw_refs = {
+        "patient": _field(_field(claim, 'patient'), 'reference'),
+        "encounter": _field(_first(_field(_first(_field(claim, 'item')), 'encounter')), 'reference'),
+        "procedure": _field(_field(_first(_field(claim, 'procedure')), 'procedureReference'), 'reference'),
+    }
+    # Claim data is client supplied; anything that isn't a usable reference is treated as missing
+    references = {resource_type: _normalize_ref(ref) for resource_type, ref in raw_refs.items()}
+    
+    if bundle.resource_types:
+        resource_types = [resource_type.lower() for resource_type in bundle.resource_types]
+        unknown = [resource_type for resource_type in resource_types if resource_type not in RESOURCE_FETCHERS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unsupported resource types: {', '.join(unknown)}")
+        results = await asyncio.gather(*[_fetch_resource(resource_type, references) for resource_type in resource_types])
+        return {result.resource_type: result.data for result in results}
+    
+    # Skip the LLM entirely when the request names the resource outright
+    resource_type = _classify_from_text(bundle.requested_resource)
+    if not resource_type:
+        resource_type = await classify_intent_llm(bundle.requested_resource)
+        
+    if not resource_type:
+        raise HTTPException(status_code=400, detail="Could not determine resource type from request. Please be more specific about what information you need.")
+        
+    return await _fetch_resource(resource_type, references)
+
+def _bundle_cache_key(bundle: ClaimBundle) -> Optional[str]:
+    """Hash the full request body; blake2b is fast and no cryptographic guarantee is needed."""
+    try:
+        body = orjson.dumps(bundle.model_dump(), option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        # orjson rejects some valid JSON (e.g. integers beyond 64 bits); skip caching those
+        return None
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+@app.post("/claim-bundle", response_model=Union[ResourceResponse, Dict[str, Dict[str, Any]]])
 async def process_claim_bundle(bundle: ClaimBundle):
     """
     Process a FHIR Claim bundle and route to appropriate resource endpoint based on requested_resource.
     The requested_resource can be in natural language, and the system will intelligently determine the correct endpoint.
+    When resource_types is given, all listed resources are fetched concurrently and returned keyed by type.
     """
+    # Identical bundles resolve to the same resources, so replays are served from memory
+    key = _bundle_cache_key(bundle)
+    cached = _response_cache.get(key) if key else None
+    if cached is not None:
+        return cached
+    
     try:
-        # Extract references from the claim bundle
-        patient_ref = bundle.claim_data.get('patient', {}).get('reference', 'Not found')
-        encounter_ref = bundle.claim_data.get('item', [{}])[0].get('encounter', [{}])[0].get('reference', 'Not found')
-        procedure_ref = bundle.claim_data.get('procedure', [{}])[0].get('procedureReference', {}).get('reference', 'Not found')
-        
-        # Prepare the input for the agent
-        agent_input = {
-            "input": f"""
-            Based on the following request, determine which FHIR resource to fetch and extract the appropriate reference from the claim bundle.
-            
-            Request: {bundle.requested_resource}
-            
-            Available references in the claim bundle:
-            - Patient: {patient_ref}
-            - Encounter: {encounter_ref}
-            - Procedure: {procedure_ref}
-            
-            You must choose one of the following tools to fetch the resource:
-            - get_patient: for patient information
-            - get_encounter: for encounter/hospital information
-            - get_procedure: for procedure information
-            
-            Use the appropriate tool to fetch the resource. Only use the reference ID as input (e.g., '598285' for Encounter/598285).
-            Do not include any additional data or the full resource in the input.
-            After getting the resource, provide a final answer.
-            """,
-            "chat_history": [],
-            "agent_scratchpad": ""
-        }
-        
-        # Run the agent
-        result = agent_executor.invoke(agent_input)
-        
-        # Check if we have intermediate steps
-        if "intermediate_steps" in result and result["intermediate_steps"]:
-            # Get the last action and its result
-            last_action, last_result = result["intermediate_steps"][-1]
-            if last_result:
-                return ResourceResponse(
-                    resource_type=last_action.tool,
-                    data=last_result
-                )
-        
-        # If no intermediate steps or result, try to determine resource type from output
-        resource_type = None
-        output = result.get("output", "").lower()
-        
-        # More sophisticated resource type detection
-        if any(term in output for term in ["patient", "demographic", "personal information", "medical record", "patient history", "patient profile"]):
-            resource_type = "patient"
-        elif any(term in output for term in ["encounter", "visit", "hospital stay", "medical visit", "treatment episode", "care encounter", "hospital"]):
-            resource_type = "encounter"
-        elif any(term in output for term in ["procedure", "surgical", "operation", "treatment procedure", "medical intervention", "clinical procedure"]):
-            resource_type = "procedure"
-            
-        if not resource_type:
-            raise HTTPException(status_code=400, detail="Could not determine resource type from request. Please be more specific about what information you need.")
-            
-        # Extract the appropriate reference based on the resource type
-        if resource_type == "patient":
-            if patient_ref == "Not found":
-                raise HTTPException(status_code=400, detail="Patient reference not found in claim")
-            resource_data = get_patient_info(patient_ref)
-            
-        elif resource_type == "encounter":
-            if encounter_ref == "Not found":
-                raise HTTPException(status_code=400, detail="Encounter reference not found in claim")
-            resource_data = get_encounter_info(encounter_ref)
-            
-        elif resource_type == "procedure":
-            if procedure_ref == "Not found":
-                raise HTTPException(status_code=400, detail="Procedure reference not found in claim")
-            resource_data = get_procedure_info(procedure_ref)
-            
-        return ResourceResponse(
-            resource_type=resource_type,
-            data=resource_data
-        )
-        
+        response = await _route_claim_bundle(bundle)
+    except HTTPException:
+        # Deliberate 4xx responses and FHIR server errors keep their status
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if key:
+        _response_cache[key] = response
+    return response
 
 @app.get("/health")
 async def health_check():
@@ -258,4 +323,14 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
+    # Requests are I/O bound, so run one worker per core on uvloop/httptools.
+    # Each worker keeps its own in-memory resource cache.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="auto",
+        http="httptools",
+        log_level="warning"
+    ) 
@@ -7,13 +7,16 @@ setup(
     install_requires=[
         "fastapi>=0.104.1",
         "uvicorn>=0.24.0",
-        "langchain>=0.0.350",
-        "langchain-community>=0.0.10",
+        "uvloop>=0.19.0; sys_platform != 'win32'",
+        "httptools>=0.6.0",
+        "langchain-openai>=0.1.0",
+        "langchain-core>=0.1.0",
         "python-dotenv>=1.0.0",
         "openai>=1.3.5",
-        "requests>=2.31.0",
-        "fhir.resources>=7.0.2",
-        "pydantic>=1.9.0,<2.0.0",
+        "httpx[http2]>=0.24.1",
+        "cachetools>=5.3.0",
+        "orjson>=3.9.0",
+        "pydantic>=2.6",
         "python-multipart>=0.0.6",
     ],
     python_requires=">=3.8",
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from main import app
+
+client = TestClient(app)
+
+CLAIM_DATA = {
+    "patient": {"reference": "Patient/12345"},
+    "item": [{"encounter": [{"reference": "Encounter/67890"}]}],
+    "procedure": [{"procedureReference": {"reference": "Procedure/11111"}}]
+}
+
+
+class FakeFhirServer:
+    """Records requests to the FHIR client and answers them with canned responses."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.responses.get(request.url.path)
+        if response is None:
+            return httpx.Response(404)
+        return response(request) if callable(response) else response
+
+    def resource(self, resource_type: str, resource_id: str, **kwargs):
+        body = {"resourceType": resource_type, "id": resource_id}
+        self.responses[f"/baseR4/{resource_type}/{resource_id}"] = httpx.Response(200, json=body, **kwargs)
+        return body
+
+
+@pytest.fixture(autouse=True)
+def fhir(monkeypatch):
+    server = FakeFhirServer()
+    monkeypatch.setattr(main, "_http", httpx.AsyncClient(
+        base_url=main.HAPI_FHIR_BASE_URL,
+        transport=httpx.MockTransport(server.handler)
+    ))
+    main._resource_cache.clear()
+    main._response_cache.clear()
+    return server
+
+
+@pytest.fixture
+def llm_labels(monkeypatch):
+    """Replace the LLM classifier, recording each request it is asked about."""
+    calls = []
+
+    async def classify(requested_resource):
+        calls.append(requested_resource)
+        return "procedure"
+
+    monkeypatch.setattr(main, "classify_intent_llm", classify)
+    return calls
+
+
+def test_single_category_request_skips_llm(fhir, llm_labels):
+    patient = fhir.resource("Patient", "12345")
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Show me the patient demographics",
+        "claim_data": CLAIM_DATA
+    })
+    assert response.status_code == 200
+    assert response.json() == {"resource_type": "patient", "data": patient}
+    assert llm_labels == []
+
+
+def test_mixed_category_request_is_left_to_llm(fhir, llm_labels):
+    procedure = fhir.resource("Procedure", "11111")
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "What procedure did the patient undergo",
+        "claim_data": CLAIM_DATA
+    })
+    assert response.status_code == 200
+    assert response.json() == {"resource_type": "procedure", "data": procedure}
+    assert llm_labels == ["What procedure did the patient undergo"]
+
+
+def test_resource_with_large_integer_is_returned(fhir):
+    body = {"resourceType": "Patient", "id": "12345", "extension": [{"valueInteger64": 2 ** 70}]}
+    fhir.responses["/baseR4/Patient/12345"] = httpx.Response(200, json=body)
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Patient",
+        "claim_data": CLAIM_DATA
+    })
+    assert response.status_code == 200
+    assert response.json() == {"resource_type": "patient", "data": body}
+
+def fetch(resource_type, resource_id):
+    return asyncio.run(main.fetch_fhir_resource(resource_type, resource_id))
+
+
+def expire(resource_type, resource_id):
+    main._resource_cache[(resource_type, resource_id)]["expires"] = 0
+
+
+def test_fresh_resource_is_served_from_cache(fhir):
+    patient = fhir.resource("Patient", "1", headers={"ETag": 'W/"1"'})
+    assert fetch("Patient", "1") == patient
+    assert fetch("Patient", "1") == patient
+    assert len(fhir.requests) == 1
+
+
+def test_stale_resource_is_revalidated_with_etag(fhir):
+    patient = fhir.resource("Patient", "1", headers={"ETag": 'W/"1"'})
+    fetch("Patient", "1")
+    expire("Patient", "1")
+    fhir.responses["/baseR4/Patient/1"] = httpx.Response(304)
+
+    assert fetch("Patient", "1") == patient
+    assert fhir.requests[-1].headers["If-None-Match"] == 'W/"1"'
+    assert main._resource_cache[("Patient", "1")]["expires"] > time.monotonic()
+
+
+def test_changed_resource_replaces_cache_entry(fhir):
+    fhir.resource("Patient", "1", headers={"ETag": 'W/"1"'})
+    fetch("Patient", "1")
+    expire("Patient", "1")
+    updated = {"resourceType": "Patient", "id": "1", "active": True}
+    fhir.responses["/baseR4/Patient/1"] = httpx.Response(200, json=updated, headers={"ETag": 'W/"2"'})
+
+    assert fetch("Patient", "1") == updated
+    assert main._resource_cache[("Patient", "1")]["etag"] == 'W/"2"'
+    assert main._resource_cache[("Patient", "1")]["body"] == updated
+
+
+def test_failed_fetch_is_not_cached(fhir):
+    with pytest.raises(HTTPException) as error:
+        fetch("Patient", "missing")
+    assert error.value.status_code == 404
+    assert ("Patient", "missing") not in main._resource_cache
+
+def test_unknown_resource_types_return_400():
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Patient",
+        "resource_types": ["foo"],
+        "claim_data": {"patient": {"reference": "Patient/12345"}}
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unsupported resource types: foo"
+
+
+def test_unusable_reference_is_treated_as_missing():
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Patient",
+        "claim_data": {"patient": {"reference": {"display": "John Doe"}}}
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Patient reference not found in claim"
+
+
+@pytest.mark.parametrize("requested_resource, claim_data", [
+    ("Patient", {"patient": "Patient/1"}),
+    ("Encounter", {"item": {"encounter": [{"reference": "Encounter/1"}]}}),
+    ("Encounter", {"item": [{"encounter": "Encounter/1"}]}),
+    ("Encounter", {"item": []}),
+    ("Procedure", {"procedure": ["Procedure/1"]}),
+])
+def test_mis_shaped_claim_data_is_treated_as_missing_reference(fhir, requested_resource, claim_data):
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": requested_resource,
+        "claim_data": claim_data
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == f"{requested_resource} reference not found in claim"
+    assert fhir.requests == []
+
+
+@pytest.mark.parametrize("reference", ["Patient/", "#contained1", "Patient/1?_count=5"])
+def test_malformed_reference_id_is_treated_as_missing(fhir, reference):
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Patient",
+        "claim_data": {"patient": {"reference": reference}}
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Patient reference not found in claim"
+    assert fhir.requests == []
+
+def test_bundle_with_large_integer_is_routed(fhir):
+    patient = fhir.resource("Patient", "12345")
+    response = client.post("/claim-bundle", json={
+        "resource_type": "Claim",
+        "requested_resource": "Patient",
+        "claim_data": {**CLAIM_DATA, "total": 2 ** 70}
+    })
+    assert response.status_code == 200
+    assert response.json()["data"] == patient
+
+
+def test_replayed_bundle_is_served_from_response_cache(fhir):
+    patient = fhir.resource("Patient", "12345")
+    body = {"resource_type": "Claim", "requested_resource": "Patient", "claim_data": CLAIM_DATA}
+    first = client.post("/claim-bundle", json=body)
+    # Drop the resource cache so only the response cache can avoid a FHIR call
+    main._resource_cache.clear()
+    second = client.post("/claim-bundle", json=body)
+    assert first.json() == second.json() == {"resource_type": "patient", "data": patient}
+    assert len(fhir.requests) == 1
+
+
+def test_error_responses_are_not_cached(fhir):
+    body = {"resource_type": "Claim", "requested_resource": "Patient", "claim_data": {}}
+    assert client.post("/claim-bundle", json=body).status_code == 400
+    assert len(main._response_cache) == 0